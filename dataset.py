@@ -64,6 +64,9 @@ class Normalization:
     def __init__(self, mean, std):
         self.mean = DataPerDevice(mean)
         self.std = DataPerDevice(std)
+        # scales are cached so that (de)normalization doesn't calculate them every call
+        self.scale = DataPerDevice(2 * std)
+        self.inv_scale = DataPerDevice(1 / (2 * std))
 
     @classmethod
     def calc_const(cls, all_files: List[Path], key: str):
@@ -129,19 +132,19 @@ class Normalization:
 
     # normalize and denormalize functions can accept a ndarray or a tensor.
     def normalize(self, a):
-        return (a - self.mean.get_like(a)) / (2 * self.std.get_like(a))
+        return (a - self.mean.get_like(a)) * self.inv_scale.get_like(a)
 
     def normalize_(self, a):  # in-place version
         a -= self.mean.get_like(a)
-        a /= 2 * self.std.get_like(a)
+        a *= self.inv_scale.get_like(a)
 
         return a
 
     def denormalize(self, a):
-        return a * (2 * self.std.get_like(a)) + self.mean.get_like(a)
+        return a * self.scale.get_like(a) + self.mean.get_like(a)
 
     def denormalize_(self, a):  # in-place version
-        a *= 2 * self.std.get_like(a)
+        a *= self.scale.get_like(a)
         a += self.mean.get_like(a)
 
         return a
@@ -241,7 +244,8 @@ class MulchWavDataset(Dataset):
         Important data like x, y are all converted to Tensor(cpu).
         :param batch:
         :return:
-            Values can be an Tensor(cpu), list of str, ndarray of int.
+            Values can be an Tensor(cpu), list of str, ndarray of int, bool.
+            `same_len` is True when all `T_ys` are the same.
         """
         result = dict()
         T_xs = np.array([item.pop('T_x') for item in batch])
@@ -250,7 +254,8 @@ class MulchWavDataset(Dataset):
         batch = [batch[i] for i in idxs_sorted]
         T_ys = np.array([item.pop('T_y') for item in batch])
 
-        result['T_xs'], result['T_ys'] = T_xs, T_ys
+        result['T_xs'], result['T_ys'] = T_xs, torch.from_numpy(T_ys)
+        result['same_len'] = bool((T_ys == T_ys[0]).all())
 
         for key, value in batch[0].items():
             if type(value) == str:
@@ -286,7 +291,7 @@ class MulchWavDataset(Dataset):
         """
         result = dict()
         for key, value in batch.items():
-            if not key.startswith('T_'):
+            if not key.startswith('T_') and key != 'same_len':
                 T_xy = f'T_{key}s'
                 result[key] = value[idx, :, :batch[T_xy][idx]].numpy()
 
@@ -20,9 +20,8 @@ class Channel(Enum):
 
 @dataclass
 class _HyperParameters:
-    # devices
+    # devices (multiple devices: run with torchrun, one process per device)
     device: Union[int, str, Sequence[str], Sequence[int]] = (0, 1, 2, 3)
-    out_device: Union[int, str] = 3
     num_disk_workers: int = 4
 
     # select dataset
@@ -50,9 +49,14 @@ class _HyperParameters:
     train_ratio: float = 0.7
     n_epochs: int = 150
     batch_size: int = 4 * 4
+    max_seg_per_step: int = 4 * 4  # max. no. of segments in one forward (total over all GPUs)
     learning_rate: float = 5e-4
     weight_decay: float = 0  # Adam weight_decay
     weight_loss: tuple = (0.1, 1)  # L1, MSE
+    use_amp: bool = True  # automatic mixed precision
+    use_compile: bool = False  # torch.compile for training
+    cudnn_benchmark: bool = True  # only for training (fixed-length segments)
+    period_log: int = 10  # iterations between updates of the printed loss
 
     # reconstruction
     do_bnkr_eq: bool = True
@@ -2,27 +2,34 @@
 
 Usage:
 ```
-    python main.py {--train, --test={seen, unseen}}
+    python main.py {--train, --test={seen, unseen}, --export}
                    [--room_train ROOM_TRAIN]
                    [--room_test ROOM_TEST]
                    [--logdir LOGDIR]
                    [--n_epochs MAX_EPOCH]
                    [--from START_EPOCH]
-                   [--device DEVICES] [--out_device OUT_DEVICE]
+                   [--device DEVICES]
                    [--batch_size B]
                    [--learning_rate LR]
                    [--weight_decay WD]
                    [--model_name MODEL]
 ```
 
+To train with multiple GPUs, launch one process per device in DEVICES:
+```
+    torchrun --nproc_per_node=N main.py --train --device DEVICES ...
+```
+N must be the number of DEVICES. `--test` and `--export` run in a single process.
+
 More parameters are in `hparams.py`.
-- specify `--train` or `--test {seen, unseen}`.
+- specify `--train` or `--test {seen, unseen}`
+  or `--export` to save the model of START_EPOCH as ONNX and TorchScript files.
 - ROOM_TRAIN: room used to train
 - ROOM_TEST: room used to test
 - LOGDIR: log directory
 - MAX_EPOCH: maximum epoch
 - START_EPOCH: start epoch (Default: -1)
-- DEVICES, OUT_DEVICE, B, LR, WD, MODEL: read `hparams.py`.
+- DEVICES, B, LR, WD, MODEL: read `hparams.py`.
 """
 # noinspection PyUnresolvedReferences
 import matlab.engine
@@ -31,7 +38,8 @@ import os
 import shutil
 from argparse import ArgumentError, ArgumentParser
 
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler
 
 from hparams import hp
 from dataset import MulchWavDataset
@@ -44,16 +52,31 @@ parser = ArgumentParser()
 
 parser.add_argument('--train', action='store_true', )
 parser.add_argument('--test', choices=('seen', 'unseen'), metavar='DATASET')
+parser.add_argument('--export', action='store_true', )
 parser.add_argument('--from', type=int, default=-1, dest='epoch', metavar='EPOCH')
 
 args = hp.parse_argument(parser)
 del parser
-if not (args.train ^ (args.test is not None)) or args.epoch < -1:
+if (args.train + (args.test is not None) + args.export != 1 or args.epoch < -1
+        or args.export and args.epoch == -1):
     raise ArgumentError
 
+# one process per GPU under torchrun.
+# The process group must exist before the datasets are built.
+if 'LOCAL_RANK' in os.environ:
+    if not args.train and int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        raise ValueError('--test and --export run in a single process. Launch without torchrun.')
+    dist.init_process_group(backend='nccl')
+    group_host = dist.new_group(backend='gloo')  # to synchronize host-side jobs
+    is_main_process = dist.get_rank() == 0
+else:
+    group_host = None
+    is_main_process = True
+
 # directory
 logdir_train = hp.logdir / 'train'
-if (args.train and args.epoch == -1 and
+will_continue = [True]
+if (is_main_process and args.train and args.epoch == -1 and
         logdir_train.exists() and list(logdir_train.glob(tfevents_fname))):
     ans = input(form_overwrite_msg.format(logdir_train))
     if ans.lower() == 'y':
@@ -67,7 +90,12 @@ if (args.train and args.epoch == -1 and
         except FileNotFoundError:
             pass
     else:
-        exit()
+        will_continue[0] = False
+if group_host is not None:
+    # the other processes follow the answer of the main process
+    dist.broadcast_object_list(will_continue, src=0, group=group_host)
+if not will_continue[0]:
+    exit()
 os.makedirs(logdir_train, exist_ok=True)
 
 if args.test:
@@ -94,25 +122,45 @@ if first_epoch > 0:
 else:
     path_state_dict = None
 
+if args.export:
+    # noinspection PyUnboundLocalVariable
+    Trainer(path_state_dict).export(path_state_dict.with_suffix('.onnx'))
+    exit()
+
 # Training + Validation Set
+# The main process chooses the files and calculates the normalization constants,
+# and the other processes load them, so that all processes use the same split.
+if not is_main_process:
+    dist.barrier(group_host)
+    hp.refresh_const = False
 dataset_temp = MulchWavDataset('train', n_file=hp.n_file)
+if is_main_process and group_host is not None:
+    dist.barrier(group_host)
 dataset_train, dataset_valid = MulchWavDataset.split(dataset_temp, (hp.train_ratio, -1))
 
 # run
 trainer = Trainer(path_state_dict)
 if args.train:
+    # hp.batch_size is the total batch size over all processes
+    if trainer.world_size > 1:
+        sampler_train = DistributedSampler(dataset_train, shuffle=True)
+    else:
+        sampler_train = None
     loader_train = DataLoader(dataset_train,
-                              batch_size=hp.batch_size,
+                              batch_size=hp.batch_size // trainer.world_size,
                               num_workers=hp.num_disk_workers,
                               collate_fn=dataset_train.pad_collate,
                               pin_memory=True,
-                              shuffle=True,
+                              persistent_workers=hp.num_disk_workers > 0,
+                              sampler=sampler_train,
+                              shuffle=sampler_train is None,
                               )
     loader_valid = DataLoader(dataset_valid,
                               batch_size=hp.batch_size,
                               num_workers=hp.num_disk_workers,
                               collate_fn=dataset_valid.pad_collate,
                               pin_memory=True,
+                              persistent_workers=hp.num_disk_workers > 0,
                               shuffle=False,
                               )
 
@@ -130,6 +178,7 @@ else:  # args.test
                         num_workers=hp.num_disk_workers,
                         collate_fn=dataset_test.pad_collate,
                         pin_memory=True,
+                        persistent_workers=hp.num_disk_workers > 0,
                         shuffle=False,
                         )
 
@@ -1,12 +1,17 @@
+import contextlib
+import os
 from pathlib import Path
-from typing import Dict, Sequence, Tuple
+from typing import Dict, Optional, Tuple
 
 import numpy as np
 import torch
 from numpy import ndarray
 from torch import nn, Tensor
+import torch.nn.functional as F
+import torch.distributed as dist
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
 from torchsummary import summary
 from tqdm import tqdm
 
@@ -30,12 +35,17 @@ class Trainer:
         else:
             criterion_names = hp.criterion_names
         self.criterions = [
-            eval(f'nn.{name}')(reduction='sum') for name in criterion_names
+            eval(f'nn.{name}')(reduction='none') for name in criterion_names
         ]
 
-        self.__init_device(hp.device, hp.out_device)
+        self.__init_device(hp.device)
 
         self.writer: CustomWriter = None
+        self._loss_buf = torch.zeros(len(self.criterions), device=self.out_device)
+
+        # mixed precision (fp16) is used only on GPUs
+        self.use_amp = hp.use_amp and self.in_device.type == 'cuda'
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.use_amp)
 
         self.optimizer = optim.Adam(self.model.parameters(),
                                     lr=hp.learning_rate,
@@ -44,29 +54,37 @@ class Trainer:
 
         # Load State Dict
         if path_state_dict:
-            st_model, st_optim = torch.load(path_state_dict, self.in_device)
+            # old checkpoints don't have the state of the grad scaler
+            st_model, st_optim, *st_scaler = torch.load(path_state_dict, self.in_device)
             try:
-                if isinstance(self.model, nn.DataParallel):
-                    self.model.module.load_state_dict(st_model)
-                else:
-                    self.model.load_state_dict(st_model)
+                self._core_model.load_state_dict(st_model)
                 self.optimizer.load_state_dict(st_optim)
             except RuntimeError:
                 raise Exception('The model is different from the state dict.')
+            # the state is empty if the checkpoint was saved without AMP
+            if st_scaler and st_scaler[0] and self.use_amp:
+                self.scaler.load_state_dict(st_scaler[0])
 
         path_summary = hp.logdir / 'summary.txt'
-        if not path_summary.exists():
+        if self.rank == 0 and not path_summary.exists():
             print_to_file(
                 path_summary,
                 summary,
-                (self.model, hp.dummy_input_size),
+                (self._core_model, hp.dummy_input_size),
                 dict(device=self.str_device[:4])
             )
             with (hp.logdir / 'hparams.txt').open('w') as f:
                 f.write(repr(hp))
 
-    def __init_device(self, device, out_device):
+    def __init_device(self, device):
+        # the model without the DDP wrapper (same parameters as self.model)
+        self._core_model: nn.Module = self.model
+        self.rank = 0
+        self.world_size = 1
+        self._copy_stream = None
         if device == 'cpu':
+            if dist.is_initialized() and dist.get_world_size() > 1:
+                raise ValueError('Multiple processes need one GPU for each process.')
             self.in_device = torch.device('cpu')
             self.out_device = torch.device('cpu')
             self.str_device = 'cpu'
@@ -81,74 +99,178 @@ class Trainer:
             if type(device[0]) != int:
                 device = [int(d.replace('cuda:', '')) for d in device]
 
-        self.in_device = torch.device(f'cuda:{device[0]}')
-
-        if len(device) > 1:
-            if type(out_device) == int:
-                self.out_device = torch.device(f'cuda:{out_device}')
-            else:
-                self.out_device = torch.device(out_device)
-            self.str_device = ', '.join([f'cuda:{d}' for d in device])
-
-            self.model = nn.DataParallel(self.model,
-                                         device_ids=device,
-                                         output_device=self.out_device)
+        if len(device) > 1 and 'LOCAL_RANK' not in os.environ:
+            print(f'Not launched by torchrun. Only cuda:{device[0]} is used.')
+            device = device[:1]
+
+        # main.py initializes the process group before the datasets
+        if len(device) > 1 and not dist.is_initialized():
+            dist.init_process_group(backend='nccl')
+
+        if dist.is_initialized():
+            # one process per GPU
+            self.rank = dist.get_rank()
+            self.world_size = dist.get_world_size()
+            if self.world_size != len(device):
+                raise ValueError(f'{self.world_size} processes for {len(device)} devices.')
+            local_rank = int(os.environ.get('LOCAL_RANK', self.rank))
+            self.in_device = torch.device(f'cuda:{device[local_rank]}')
         else:
-            self.out_device = self.in_device
-            self.str_device = str(self.in_device)
+            self.in_device = torch.device(f'cuda:{device[0]}')
+
+        self.out_device = self.in_device
+        self.str_device = str(self.in_device)
 
         self.model.cuda(self.in_device)
         for criterion in self.criterions:
             criterion.cuda(self.out_device)
 
         torch.cuda.set_device(self.in_device)
+        # host-to-device copies of the next batch overlap with the current step
+        self._copy_stream = torch.cuda.Stream(device=self.in_device)
 
-    def _pre(self, data: Dict[str, Tensor], dataset: MulchWavDataset) \
-            -> Tuple[Tensor, Tensor]:
+        if self.world_size > 1:
+            self.model = DDP(self.model,
+                             device_ids=[self.in_device],
+                             broadcast_buffers=False)
+
+    def _wrap_loader(self, loader: DataLoader) -> DataLoader:
+        """ Rebuild `loader` if it doesn't use persistent workers and pinned memory.
+
+        `non_blocking` copies in `_pre` are only asynchronous
+        when the batches are in page-locked memory.
+        Prefetching more than 2 batches per worker only costs memory.
+
+        :param loader:
+        :return: `loader` itself or a new DataLoader with the same dataset, sampler and worker settings.
+        """
+        on_gpu = self.in_device.type == 'cuda'
+        if on_gpu and hp.num_disk_workers == 0:
+            raise ValueError('hp.num_disk_workers must be positive when using GPUs.')
+
+        kwargs = dict(num_workers=hp.num_disk_workers, pin_memory=on_gpu)
+        if hp.num_disk_workers > 0:
+            kwargs.update(persistent_workers=True, prefetch_factor=2)
+
+        if any(getattr(loader, k) != v for k, v in kwargs.items()):
+            if loader.batch_size is None and loader.batch_sampler is not None:
+                # batch_size, sampler and drop_last are mutually exclusive with batch_sampler
+                batching = dict(batch_sampler=loader.batch_sampler)
+            else:
+                batching = dict(batch_size=loader.batch_size,
+                                sampler=loader.sampler,
+                                drop_last=loader.drop_last,
+                                )
+            loader = DataLoader(loader.dataset,
+                                collate_fn=loader.collate_fn,
+                                timeout=loader.timeout,
+                                worker_init_fn=loader.worker_init_fn,
+                                multiprocessing_context=loader.multiprocessing_context,
+                                generator=loader.generator,
+                                **batching,
+                                **kwargs,
+                                )
+        if self.rank == 0:
+            print('DataLoader: ' + ', '.join(f'{k}={v}' for k, v in kwargs.items()))
+
+        return loader
+
+    def _pre(self, data: Dict[str, Tensor], dataset: MulchWavDataset, with_T_ys=False) \
+            -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+        """ copy and normalize x, y on `self._copy_stream`.
+
+        :param with_T_ys: copy `data['T_ys']` to `self.out_device` too. Otherwise, None is returned.
+        :return: x, y, T_ys
+        """
         # B, C, T
         x = data['x']
         y = data['y']
+        T_ys = None
+
+        # no-op if self._copy_stream is None (cpu)
+        with torch.cuda.stream(self._copy_stream):
+            x = x.to(self.in_device, non_blocking=True)
+            y = y.to(self.out_device, non_blocking=True)
+            if with_T_ys:
+                T_ys = data['T_ys'].to(self.out_device, non_blocking=True)
 
-        x = x.to(self.in_device, non_blocking=True)
-        y = y.to(self.out_device, non_blocking=True)
+            x = dataset.norm_in.normalize_(x)
+            y = dataset.norm_out.normalize_(y)
 
-        x = dataset.norm_in.normalize_(x)
-        y = dataset.norm_out.normalize_(y)
+        if self._copy_stream is not None:
+            # kernels queued after this wait for the copy,
+            # while kernels of the previous step can still run during the copy.
+            stream = torch.cuda.current_stream()
+            stream.wait_stream(self._copy_stream)
+            for a in (x, y, T_ys):
+                if a is not None:
+                    a.record_stream(stream)
 
-        return x, y
+        return x, y, T_ys
 
     @torch.no_grad()
-    def _post_one(self, output: Tensor, Ts: ndarray,
-                  idx: int, normalization: Normalization) -> Dict[str, ndarray]:
-        one = output[idx, :, :Ts[idx]]  # C, T
+    def _post_one(self, output: Tensor, Ts: Tensor,
+                  idx: int, normalization: Normalization) \
+            -> Tuple[Tensor, Optional[torch.cuda.Event]]:
+        """ denormalize the `idx`-th output and start copying it to pinned host memory.
+
+        :return: C, T tensor(cpu) and the event to wait for before reading it (None on cpu)
+        """
+        one = output[idx, :, :Ts[idx]].float()  # C, T
 
         one = normalization.denormalize_(one)
-        one = one.cpu().numpy()
+        if one.device.type == 'cpu':
+            return one, None
+
+        one_host = torch.empty(one.shape, dtype=one.dtype, pin_memory=True)
+        one_host.copy_(one, non_blocking=True)
+
+        return one_host, torch.cuda.current_stream().record_event()
 
-        return dict(out=one)
+    @staticmethod
+    def _wait_post_one(one: Tensor, event: Optional[torch.cuda.Event]) -> Dict[str, ndarray]:
+        if event is not None:
+            event.synchronize()
 
-    def _calc_loss(self, y: Tensor, output: Tensor, T_ys: Sequence[int]) -> Tensor:
-        loss = torch.zeros(len(self.criterions), device=self.out_device)
-        if (T_ys == T_ys[0]).all():
+        return dict(out=one.numpy())
+
+    def _calc_loss(self, y: Tensor, output: Tensor, T_ys: Tensor, same_len: bool) -> Tensor:
+        """ sum of the losses of all samples.
+        The loss of each sample is averaged over its own length.
+        The result shares memory with `self._loss_buf`, so it is valid only until the next call.
+
+        :param T_ys: lengths of samples (on `self.out_device`)
+        :param same_len: whether all `T_ys` are the same
+        """
+        # detach() keeps the autograd history off the buffer itself
+        loss = self._loss_buf.detach().zero_()
+        if same_len:
             for i, criterion in enumerate(self.criterions):
                 if hp.weight_loss[i] == 0:
                     continue
-                loss[i] = hp.weight_loss[i] * criterion(output, y) / T_ys[0]
+                loss[i] = hp.weight_loss[i] * criterion(output, y).sum() / T_ys[0]
         else:
-            loss = torch.zeros(len(self.criterions), device=self.out_device)
+            # B, 1, T
+            mask = torch.arange(y.shape[-1], device=self.out_device) < T_ys[:, None, None]
             for i, criterion in enumerate(self.criterions):
                 if hp.weight_loss[i] == 0:
                     continue
-                for T, item_y, item_out in zip(T_ys, y, output):
-                    loss[i] += criterion(item_out[..., :T], item_y[..., :T]) / int(T)
-                loss[i] *= hp.weight_loss[i]
+                loss_each = (criterion(output, y) * mask).sum(dim=(1, 2)) / T_ys
+                loss[i] = hp.weight_loss[i] * loss_each.sum()
 
         return loss
 
     def train(self, loader_train: DataLoader, loader_valid: DataLoader, logdir: Path,
               first_epoch=0):
 
+        loader_train = self._wrap_loader(loader_train)
+        loader_valid = self._wrap_loader(loader_valid)
+
         n_train_data = len(loader_train.dataset)
+        # fraction of an epoch per iteration
+        frac_iter = hp.batch_size / n_train_data
+        # hp.max_seg_per_step is shared by all processes like hp.batch_size
+        max_seg = max(hp.max_seg_per_step // self.world_size, 1)
         # Learning Rates Scheduler
         scheduler = optim.lr_scheduler.CosineAnnealingWarmRestarts(
             self.optimizer,
@@ -156,11 +278,27 @@ class Trainer:
             **hp.scheduler
         )
         avg_loss = torch.zeros(len(self.criterions), device=self.out_device)
+        # printed loss is accumulated on the device for `hp.period_log` iterations
+        loss_log = torch.zeros(len(self.criterions), device=self.out_device)
+        n_seg_log = 0
+
+        # Only the training forward is compiled. Validation, test and export use the eager model.
+        # The number of segments varies with batches, so dim 0 is dynamic.
+        if hp.use_compile:
+            model_train = torch.compile(self.model, dynamic=True)
+        else:
+            model_train = self.model
 
-        self.writer = CustomWriter(str(logdir), group='valid', purge_step=first_epoch)
+        if self.rank == 0:
+            self.writer = CustomWriter(str(logdir), group='valid', purge_step=first_epoch)
+
+        # cuDNN picks the fastest conv algorithm (incl. Tensor Core kernels) for each input shape.
+        # It's enabled only for training segments of the fixed length,
+        # while the lengths vary in validation.
+        cudnn_benchmark_prev = torch.backends.cudnn.benchmark
 
         # self.writer.add_graph(
-        #     self.model.module if isinstance(self.model, nn.DataParallel) else self.model,
+        #     self._core_model,
         #     torch.zeros(2, *hp.dummy_input_size),
         #     # operator_export_type='RAW',
         # )
@@ -169,66 +307,117 @@ class Trainer:
         for epoch in range(first_epoch, hp.n_epochs):
 
             print()
-            pbar = tqdm(loader_train, desc=f'epoch {epoch:3d}', postfix='[]', dynamic_ncols=True)
+            torch.backends.cudnn.benchmark = hp.cudnn_benchmark
+            avg_loss.zero_()
+            # i_iter restarts, so the leftover of the last epoch isn't carried over
+            loss_log.zero_()
+            n_seg_log = 0
+            if isinstance(loader_train.sampler, DistributedSampler):
+                loader_train.sampler.set_epoch(epoch)
+            pbar = tqdm(loader_train, desc=f'epoch {epoch:3d}', postfix='[]', dynamic_ncols=True,
+                        disable=self.rank != 0)
 
             for i_iter, data in enumerate(pbar):
                 # get data
-                x, y = self._pre(data, loader_train.dataset)  # B, C, T
-                T_ys = data['T_ys']
-
-                i_first = 0
-                loss_t = None
-                for t in range(0, y.shape[-1], hp.l_target):
-                    self.optimizer.zero_grad()
-                    while i_first < y.shape[0] and t >= T_ys[i_first]:
-                        i_first += 1
-                    seg_y = y[i_first:, :, t: t + hp.l_target]
-                    if seg_y.shape[-1] < 5:
-                        break
-                    seg_x = x[i_first:, :, t: t + hp.l_input]
-                    seg_T_ys = np.clip(T_ys[i_first:] - t,
-                                       a_min=None, a_max=hp.l_target)
-
-                    # forward
-                    output = self.model(seg_x)[..., :seg_y.shape[-1]]  # B, C, T
-
-                    loss_t = self._calc_loss(seg_y, output, seg_T_ys)
-                    loss_t_sum = loss_t.sum()
-
-                    # backward
-                    loss_t_sum.backward()
-                    self.optimizer.step()
+                x, y, _ = self._pre(data, loader_train.dataset)  # B, C, T
+                T_ys = data['T_ys']  # cpu
+
+                # segments of all samples are stacked along the batch axis
+                n_seg = -(-y.shape[-1] // hp.l_target)
+                x_pad = F.pad(x, [0, (n_seg - 1) * hp.l_target + hp.l_input - x.shape[-1]])
+                y_pad = F.pad(y, [0, n_seg * hp.l_target - y.shape[-1]])
+                # B, n_seg
+                # calculated on the host: selecting valid segments on the device needs a sync.
+                seg_T_ys = T_ys[:, None] - torch.arange(0, y.shape[-1], hp.l_target)
+                seg_T_ys.clamp_(0, hp.l_target)
+
+                # drop the segments that are zero-padded or shorter than 5 samples
+                idx_b, idx_seg = (seg_T_ys >= 5).nonzero(as_tuple=True)
+                seg_T_ys = seg_T_ys[idx_b, idx_seg]
+                n_seg_valid = len(seg_T_ys)
+
+                # B, n_seg, C, l
+                seg_x_all = x_pad.unfold(-1, hp.l_input, hp.l_target).transpose(1, 2)
+                seg_y_all = y_pad.unfold(-1, hp.l_target, hp.l_target).transpose(1, 2)
+                idx_b_x = idx_b.to(self.in_device, non_blocking=True)
+                idx_seg_x = idx_seg.to(self.in_device, non_blocking=True)
+                idx_b_y = idx_b.to(self.out_device, non_blocking=True)
+                idx_seg_y = idx_seg.to(self.out_device, non_blocking=True)
+                seg_T_ys_dev = seg_T_ys.to(self.out_device, non_blocking=True)
+
+                # at most `max_seg` segments per forward.
+                # gradients are accumulated and the optimizer steps once per batch.
+                self.optimizer.zero_grad(set_to_none=True)
+                for i_first in range(0, n_seg_valid, max_seg):
+                    chunk = slice(i_first, i_first + max_seg)
+                    seg_x = seg_x_all[idx_b_x[chunk], idx_seg_x[chunk]]  # n, C, l_input
+                    seg_y = seg_y_all[idx_b_y[chunk], idx_seg_y[chunk]]  # n, C, l_target
+                    # only full segments can skip the mask. A partial one has padded zeros in seg_y.
+                    seg_same_len = bool((seg_T_ys[chunk] == hp.l_target).all())
+
+                    # DDP all-reduces the gradients only in the last backward
+                    if self.world_size > 1 and chunk.stop < n_seg_valid:
+                        sync_context = self.model.no_sync()
+                    else:
+                        sync_context = contextlib.nullcontext()
+
+                    with sync_context:
+                        # forward
+                        with torch.autocast('cuda', enabled=self.use_amp):
+                            output = model_train(seg_x)  # n, C, l_target
+
+                            loss_t = self._calc_loss(seg_y, output, seg_T_ys_dev[chunk],
+                                                     seg_same_len)
+                            loss_t_sum = loss_t.sum()
+
+                        # backward
+                        self.scaler.scale(loss_t_sum).backward()
 
                     # print
-                    avg_loss += loss_t.detach_()
-                    del loss_t_sum, seg_x, seg_y, output
+                    with torch.no_grad():
+                        avg_loss.add_(loss_t)
+                        loss_log.add_(loss_t)
+
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                n_seg_log += n_seg_valid
 
-                scheduler.step(epoch + i_iter * hp.batch_size / n_train_data)
+                scheduler.step(epoch + i_iter * frac_iter)
 
-                loss_t_last_np = loss_t.cpu().numpy() / len(T_ys)
-                pbar.set_postfix_str(arr2str(loss_t_last_np, ndigits=1))
+                if i_iter % hp.period_log == hp.period_log - 1:
+                    loss_log_np = loss_log.cpu().numpy() / n_seg_log
+                    pbar.set_postfix_str(arr2str(loss_log_np, ndigits=1))
+                    loss_log.zero_()
+                    n_seg_log = 0
 
+            if self.world_size > 1:
+                dist.all_reduce(avg_loss)
             avg_loss /= n_train_data
-            tag = 'loss/train'
-            self.writer.add_scalar(tag, avg_loss.sum().item(), epoch)
-            if len(self.criterions) > 1:
-                for i, (n, ll) in enumerate(zip(hp.criterion_names, avg_loss)):
-                    self.writer.add_scalar(f'{tag}/{i + 1}_{n}', ll.item(), epoch)
-
-            # Validation
-            self.validate(loader_valid, logdir, epoch)
-
-            # save loss & model
-            if epoch % hp.period_save_state == hp.period_save_state - 1:
-                torch.save(
-                    (self.model.module.state_dict()
-                     if isinstance(self.model, nn.DataParallel)
-                     else self.model.state_dict(),
-                     self.optimizer.state_dict(),
-                     ),
-                    logdir / f'{hp.model_name}_{epoch}.pt'
-                )
-        self.writer.close()
+            if self.rank == 0:
+                tag = 'loss/train'
+                self.writer.add_scalar(tag, avg_loss.sum().item(), epoch)
+                if len(self.criterions) > 1:
+                    for i, (n, ll) in enumerate(zip(hp.criterion_names, avg_loss)):
+                        self.writer.add_scalar(f'{tag}/{i + 1}_{n}', ll.item(), epoch)
+
+                # Validation
+                torch.backends.cudnn.benchmark = False
+                self.validate(loader_valid, logdir, epoch)
+
+                # save loss & model
+                if epoch % hp.period_save_state == hp.period_save_state - 1:
+                    torch.save(
+                        (self._core_model.state_dict(),
+                         self.optimizer.state_dict(),
+                         self.scaler.state_dict(),
+                         ),
+                        logdir / f'{hp.model_name}_{epoch}.pt'
+                    )
+            if self.world_size > 1:
+                dist.barrier()
+        torch.backends.cudnn.benchmark = cudnn_benchmark_prev
+        if self.rank == 0:
+            self.writer.close()
 
     @torch.no_grad()
     def validate(self, loader: DataLoader, logdir: Path, epoch: int):
@@ -240,35 +429,47 @@ class Trainer:
         """
 
         self.model.eval()
+        # only rank 0 validates, so DDP must not take part in the forward.
+        model = self._core_model
 
         avg_loss = torch.zeros(len(self.criterions), device=self.out_device)
+        loss_log = torch.zeros(len(self.criterions), device=self.out_device)
+        n_data_log = 0
 
         pbar = tqdm(loader, desc='validate ', postfix='[0]', dynamic_ncols=True)
         for i_iter, data in enumerate(pbar):
             # get data
-            x, y = self._pre(data, loader.dataset)  # B, C, F, T
-            T_ys = data['T_ys']
+            x, y, T_ys = self._pre(data, loader.dataset, with_T_ys=True)  # B, C, F, T
 
             # forward
-            output = self.model(x)  # [..., :y.shape[-1]]
+            with torch.autocast('cuda', enabled=self.use_amp):
+                output = model(x)  # [..., :y.shape[-1]]
 
-            # loss
-            loss = self._calc_loss(y, output, T_ys)
+                # loss
+                loss = self._calc_loss(y, output, T_ys, data['same_len'])
             avg_loss += loss
+            loss_log += loss
+            n_data_log += len(T_ys)
 
             # print
-            loss_np = loss.cpu().numpy() / len(T_ys)
-            pbar.set_postfix_str(arr2str(loss_np, ndigits=1))
+            if i_iter % hp.period_log == hp.period_log - 1:
+                loss_log_np = loss_log.cpu().numpy() / n_data_log
+                pbar.set_postfix_str(arr2str(loss_log_np, ndigits=1))
+                loss_log.zero_()
+                n_data_log = 0
 
-            # write summary
+            # the first sample is written after the loop
             if i_iter == 0:
-                out_one = self._post_one(output, T_ys, 0, loader.dataset.norm_out)
+                post_one = self._post_one(output, data['T_ys'], 0, loader.dataset.norm_out)
 
                 if not self.writer.reused_sample:
                     one_sample = MulchWavDataset.decollate_padded(data, 0)
                 else:
                     one_sample = dict()
-                self.writer.write_one(epoch, **out_one, **one_sample)
+
+        # write summary
+        # noinspection PyUnboundLocalVariable
+        self.writer.write_one(epoch, **self._wait_post_one(*post_one), **one_sample)
 
         avg_loss /= len(loader.dataset)
         tag = 'loss/valid'
@@ -281,42 +482,74 @@ class Trainer:
 
         return avg_loss
 
+    @torch.no_grad()
+    def export(self, path: Path):
+        """ Export the model to ONNX (`path`) and TorchScript (`path` with suffix .jit.pt).
+
+        Batch size and length of the input are dynamic axes.
+
+        :param path: path of the ONNX file.
+        """
+        path = Path(path)
+        model = self._core_model
+        model.eval()
+
+        dummy_input = torch.zeros(1, *hp.dummy_input_size, device=self.in_device)
+        torch.onnx.export(model, dummy_input, str(path),
+                          input_names=['input'],
+                          output_names=['output'],
+                          dynamic_axes=dict(input={0: 'B', 2: 'T'},
+                                            output={0: 'B', 2: 'T_out'}),
+                          opset_version=17,
+                          )
+        # DWaveNet can't be scripted, but its forward doesn't depend on the input values.
+        torch.jit.trace(model, dummy_input).save(str(path.with_suffix('.jit.pt')))
+
+        model.train()
+
     @torch.no_grad()
     def test(self, loader: DataLoader, logdir: Path):
+        loader = self._wrap_loader(loader)
         group = logdir.name.split('_')[0]
 
         self.writer = CustomWriter(str(logdir), group=group)
 
-        avg_measure = None
         self.model.eval()
 
         pbar = tqdm(loader, desc=group, dynamic_ncols=True)
+
+        def write_summary(step, one, event, one_sample) -> ndarray:
+            measure = self.writer.write_one(step, **self._wait_post_one(one, event), **one_sample)
+
+            # print
+            str_measure = arr2str(measure).replace('\n', '; ')
+            pbar.write(str_measure)
+            return measure
+
+        measures = []
+        prev = None
         for i_iter, data in enumerate(pbar):
             # get data
-            x, y = self._pre(data, loader.dataset)  # B, C, T
+            x, y, _ = self._pre(data, loader.dataset)  # B, C, T
             T_ys = data['T_ys']
 
             # forward
             output = self.model(x)  # [..., :y.shape[-1]]
 
-            # write summary
             one_sample = MulchWavDataset.decollate_padded(data, 0)  # F, T, C
 
             out_one = self._post_one(output, T_ys, 0, loader.dataset.norm_out)
 
-            measure = self.writer.write_one(i_iter, **out_one, **one_sample)
-            if avg_measure is None:
-                avg_measure = measure
-            else:
-                avg_measure += measure
-
-            # print
-            str_measure = arr2str(measure).replace('\n', '; ')
-            pbar.write(str_measure)
+            # write summary of the previous sample while the GPU processes this one
+            if prev is not None:
+                measures.append(write_summary(*prev))
+            prev = (i_iter, *out_one, one_sample)
+        if prev is not None:
+            measures.append(write_summary(*prev))
 
         self.model.train()
 
-        avg_measure /= len(loader.dataset)
+        avg_measure = np.sum(measures, axis=0) / len(loader.dataset)
 
         self.writer.add_text(f'{group}/Average Measure/Proposed', str(avg_measure[0]))
         self.writer.add_text(f'{group}/Average Measure/Reverberant', str(avg_measure[1]))
@@ -14,12 +14,17 @@ def arr2str(a: np.ndarray, format_='e', ndigits=2) -> str:
     :param ndigits:
     :return:
     """
-    return np.array2string(
-        a,
-        formatter=dict(
-            float_kind=(lambda x: f'{x:.{ndigits}{format_}}' if x != 0 else '0')
-        )
-    )
+    def format_float(x):
+        return f'{x:.{ndigits}{format_}}' if x != 0 else '0'
+
+    # a short 1D array (e.g. losses) is formatted directly
+    # unless `np.array2string` would wrap it (large `ndigits` or `format_='f'`)
+    if a.ndim == 1 and a.size <= 4 and a.dtype.kind == 'f':
+        s = '[' + ' '.join(format_float(x) for x in a.tolist()) + ']'
+        if len(s) <= np.get_printoptions()['linewidth']:
+            return s
+
+    return np.array2string(a, formatter=dict(float_kind=format_float))
 
 
 def print_to_file(fname: Union[str, Path], fn: Callable, args=None, kwargs=None):